@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+'''
+Simple benchmarks for fxd.minilexer
+
+Run from repository root:
+
+    PYTHONPATH=src python benchmarks/bench_minilexer.py
+'''
+
+from fxd import minilexer
+from timeit import repeat
+import os
+import tempfile
+import time
+import tracemalloc
+
+LEXER = dict(
+    _begin = 'code',
+    code = dict(
+        match = (
+            'space',
+            'comment',
+            'string',
+            'number',
+            'keyword',
+            'name',
+            'op',
+        ),
+    ),
+    space = dict(
+        match = minilexer.MRE(r'\s+'),
+        after = 'code',
+    ),
+    comment = dict(
+        match = minilexer.MRE(r'#.*'),
+        after = 'code',
+    ),
+    string = dict(
+        match = minilexer.MRE(r'"(?:[^"\\]|\\.)*"'),
+        after = 'code',
+    ),
+    number = dict(
+        match = minilexer.MRE(r'\d+(?:\.\d+)?'),
+        after = 'code',
+    ),
+    keyword = dict(
+        match = minilexer.MM(
+            minilexer.MS('def'),
+            minilexer.MS('return'),
+        ),
+        after = 'code',
+    ),
+    name = dict(
+        match = minilexer.MRE(r'[A-Za-z_]\w*'),
+        after = 'code',
+    ),
+    op = dict(
+        match = minilexer.MRE(r'[-+*/=(),:]'),
+        after = 'code',
+    ),
+)
+
+LINES = [
+    'def spam(eggs, ham): # some comment here',
+    '    return eggs * 2 + ham / 3.5 - "a string literal with \\" escapes"',
+] * 500
+
+# Lines with large tokens - long string literals and comments
+LARGE_LINES = [
+    '"{}" # {}'.format('x' * 2000, 'y' * 2000),
+] * 500
+
+# Nested brackets - with push and pop keys ...
+NESTED_LEXER = dict(
+    _begin = 'begin',
+    begin = dict(
+        match = ('open', 'word'),
+    ),
+    nested = dict(
+        match = ('nested_open', 'close', 'nested_word'),
+    ),
+    word = dict(
+        match = minilexer.MRE(r'[a-z ]+'),
+        after = 'begin',
+    ),
+    nested_word = dict(
+        match = minilexer.MRE(r'[a-z ]+'),
+        after = 'nested',
+    ),
+    open = dict(
+        match = minilexer.MS('('),
+        push = 'nested',
+        after = 'begin',
+    ),
+    nested_open = dict(
+        match = minilexer.MS('('),
+        push = 'nested',
+        after = 'nested',
+    ),
+    close = dict(
+        match = minilexer.MS(')'),
+        pop = True,
+        after = 'begin',
+    ),
+)
+
+# ... and the same with hooks and callable after
+def push_nested(parser):
+    parser.modes.append(parser.current_state.name)
+
+def pop_nested(parser):
+    return parser.modes.pop()
+
+CLOSURE_LEXER = dict(
+    NESTED_LEXER,
+    open = dict(
+        match = minilexer.MS('('),
+        on_match = push_nested,
+        after = 'nested',
+    ),
+    nested_open = dict(
+        match = minilexer.MS('('),
+        on_match = push_nested,
+        after = 'nested',
+    ),
+    close = dict(
+        match = minilexer.MS(')'),
+        after = pop_nested,
+    ),
+)
+
+NESTED_LINES = [
+    'spam (eggs (ham) (spam (eggs)) ham) spam (eggs)',
+] * 1000
+
+class QuietParser(minilexer.Parser):
+    def token_match(self, token, match):
+        pass
+
+class DictDrivenParser(QuietParser):
+    '''
+    Parser running the old dict-driven loop - looks up token keys on every
+    match attempt and rebuilds iter_tokens generator on every state change
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset_iter(self.lexer['_begin'])
+
+    def reset_iter(self, lookup):
+        self.current_iter = self.iter_tokens(lookup)
+
+    def run_parser(self):
+        while True:
+            if self.current_pos >= len(self.current_line) and not self.readline():
+                break
+
+            result = next(self.current_iter, None)
+            if not result:
+                self.on_bad_token()
+                break
+
+            name, token = result
+            matcher = token['match']
+            after = token['after']
+
+            self.cache_push()
+
+            match = matcher.match(self, self.current_line, self.current_pos)
+            if match:
+                new_pos, match = match
+
+            if match is None:
+                self.cache_pop()
+                on_fail = token.get('on_fail')
+                if on_fail:
+                    on_fail(self)
+                continue
+
+            self.token_match(name, match)
+
+            on_match = token.get('on_match')
+            if on_match:
+                on_match(self)
+
+            callme = getattr(after, '__call__', None)
+            if callme:
+                after = callme(self)
+
+            self.current_pos = new_pos
+            self.reset_iter(after)
+            self.cache_purge()
+
+class ModesParser(QuietParser):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.modes = list()
+
+class CollectingParser(minilexer.Parser):
+    '''
+    Keeps matches like a real consumer would, until the end of input
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.matched = list()
+
+    def token_match(self, token, match):
+        self.matched.append(match)
+
+def lex(spans=False, parser_class=QuietParser):
+    parser = parser_class(LEXER, spans=spans)
+    parser.parse_lines(LINES)
+
+def lex_memory(lines, spans):
+    tracemalloc.start()
+    parser = CollectingParser(LEXER, spans=spans)
+    parser.parse_lines(lines)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def main():
+    best = min(repeat(lambda: lex(parser_class=DictDrivenParser), number=5, repeat=5)) / 5
+    print('lex {} lines (dict-driven loop): {:.2f} ms'.format(len(LINES), best * 1000))
+
+    for spans in (False, True):
+        best = min(repeat(lambda: lex(spans), number=5, repeat=5)) / 5
+        print('lex {} lines (spans={}): {:.2f} ms'.format(len(LINES), spans, best * 1000))
+
+    for name, lexer in (('push/pop', NESTED_LEXER), ('closures', CLOSURE_LEXER)):
+        compiled = minilexer.CompiledLexer(lexer)
+        def lex_nested():
+            ModesParser(compiled).parse_lines(NESTED_LINES)
+        best = min(repeat(lex_nested, number=5, repeat=5)) / 5
+        print('lex {} nested lines ({}): {:.2f} ms'.format(len(NESTED_LINES), name, best * 1000))
+
+    for name, lines in (('mixed', LINES), ('large tokens', LARGE_LINES)):
+        for spans in (False, True):
+            peak = lex_memory(lines, spans)
+            print('peak memory, {} (spans={}): {:.1f} KiB'.format(name, spans, peak / 1024))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'input.txt')
+        with open(path, 'w') as fileobj:
+            fileobj.write('\n'.join(LINES * 10))
+        cache_dir = os.path.join(tmpdir, 'cache')
+        for what in ('lex', 'reload'):
+            start = time.perf_counter()
+            with minilexer.cached_tokenize(path, LEXER, cache_dir, 'utf-8') as stream:
+                count = len(stream)
+            took = time.perf_counter() - start
+            print('cached_tokenize {} ({} tokens): {:.2f} ms'.format(what, count, took * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -18,14 +18,109 @@
 # along with this library in the file COPYING.LESSER. If not, see
 # <http://www.gnu.org/licenses/>.
 
-from logging import getLogger
+from array import array
+import ast
+import copy
+from hashlib import sha256
+from logging import getLogger, DEBUG
+import mmap
+import os
 import re
+import struct
+import sys
+import tempfile
+import types
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    # Python < 3.11
+    import sre_parse
 
 log = getLogger(__name__)
 
 def one_iter(value):
     yield value
 
+_BUFFER_LINE_RE = re.compile(rb'([^\r\n]*)(\r\n|[\r\n])|([^\r\n]+)')
+
+def split_buffer(view, eol_newline=False):
+    '''
+    Split memoryview into lines without copying - yields slices of given view.
+
+    Works like bytes.splitlines. If eol_newline is set, lines ending with "\\n"
+    are yielded together with it; other line endings have to be replaced with
+    "\\n", so such lines are copied to new bytes objects.
+    '''
+    for match in _BUFFER_LINE_RE.finditer(view):
+        start, end = match.span()
+        if match.group(3) is None:
+            if eol_newline and match.group(2) == b'\n':
+                yield view[start:end]
+                continue
+            end = match.start(2)
+        line = view[start:end]
+        if eol_newline:
+            line = bytes(line) + b'\n'
+        yield line
+
+class Span:
+    '''
+    Matched part of line, given by offsets only - text is sliced when asked
+
+    Passed to token_match instead of match objects by parsers in span mode.
+    Mimics re.Match - span(), start(), end() and group() take group index or
+    name, 0 being the whole match. Spans of groups are kept only for regexes
+    having groups.
+    '''
+    __slots__ = (
+        'line',
+        '_start',
+        '_end',
+        '_regs',
+        '_groupindex',
+    )
+
+    def __init__(self, line, start, end, regs=None, groupindex=None):
+        self.line = line
+        self._start = start
+        self._end = end
+        self._regs = regs
+        self._groupindex = groupindex
+
+    def span(self, idx=0):
+        if isinstance(idx, str):
+            if not self._groupindex or idx not in self._groupindex:
+                raise IndexError('no such group')
+            idx = self._groupindex[idx]
+        if idx == 0:
+            return self._start, self._end
+        if self._regs is None or idx < 0:
+            raise IndexError('no such group')
+        return self._regs[idx]
+
+    def start(self, idx=0):
+        return self.span(idx)[0]
+
+    def end(self, idx=0):
+        return self.span(idx)[1]
+
+    def group(self, idx=0):
+        start, end = self.span(idx)
+        if start < 0:
+            return None
+        return self.line[start:end]
+
+    def groupdict(self):
+        return {
+            name: self.group(idx)
+            for name, idx in (self._groupindex or {}).items()
+        }
+
+    @property
+    def text(self):
+        return self.line[self._start:self._end]
+
 class Matcher:
     '''
     Base class for matchers
@@ -39,6 +134,9 @@ class Matcher:
 class MRE(Matcher):
     '''
     Regular expression matcher
+
+    Given regex may be bytes pattern - it will match bytes, bytearray and
+    memoryview lines then.
     '''
     def __init__(self, regex, icase=False):
         super().__init__()
@@ -52,12 +150,21 @@ class MRE(Matcher):
     def match(self, parser, line, pos):
         match = self.regex.match(line, pos)
         if match:
-            return pos + len(match.group(0)), match
+            end = match.end()
+            if parser.spans:
+                regex = self.regex
+                if regex.groups:
+                    return end, Span(line, pos, end, match.regs, regex.groupindex)
+                return end, Span(line, pos, end)
+            return end, match
         return None
 
 class MS(Matcher):
     '''
     Simple string matcher
+
+    Given string may be bytes too - it will match bytes, bytearray and
+    memoryview lines then.
     '''
     def __init__(self, string, icase=False):
         super().__init__()
@@ -67,12 +174,22 @@ class MS(Matcher):
         self.string = string
 
     def match(self, parser, line, pos):
-        tmp = line[pos:pos+len(self.string)]
-        if self.icase:
-            tmp = tmp.lower()
+        end = pos + len(self.string)
+        if self.icase or isinstance(line, memoryview):
+            tmp = line[pos:end]
+            if self.icase:
+                if isinstance(tmp, memoryview):
+                    tmp = tmp.tobytes()
+                tmp = tmp.lower()
+            matched = tmp == self.string
+        else:
+            # no slice copy needed
+            matched = line.startswith(self.string, pos)
 
-        if tmp == self.string:
-            return pos + len(self.string), self.string
+        if matched:
+            # matched text is our string - nothing to copy, so it's passed
+            # in span mode too
+            return end, self.string
         return None
 
 class MM(Matcher):
@@ -97,6 +214,7 @@ class LexerError(Exception):
     E_MISSING_AFTER = 3
     E_LOOP = 4
     E_NO_MATCH = 5
+    E_PUSH_AND_POP = 6
 
     ID_TO_DESC = {
         E_TOKEN_NOT_FOUND: 'Token "{name}" not found.',
@@ -107,6 +225,7 @@ class LexerError(Exception):
             'Lexer error handler did not raise an error on unknown token. '
             'Also, unknown token found in line {lineno} at position {pos}.'
         ),
+        E_PUSH_AND_POP: 'Keys "push" and "pop" both found in leaf token "{name}".',
     }
     
     def __init__(self, error_id, **kwargs):
@@ -116,26 +235,252 @@ class LexerError(Exception):
     def __str__(self):
         return self.ID_TO_DESC[self.error_id].format(**self.kwargs)
 
+def iter_tokens(lexer, name, groups=None):
+    '''
+    Yields (name, token) of leaf tokens to try in lexer state name, in order
+
+    If groups list is given, names of visited groups are appended to it.
+    '''
+    onpath = set()
+    visited = set()
+
+    stack = list()
+
+    token_iter = one_iter(name)
+
+    while True:
+        name = next(token_iter, None)
+        if name is None:
+            if not stack:
+                break
+            name, token_iter = stack.pop()
+            onpath.remove(name)
+            continue
+
+        token = lexer.get(name)
+        if token is None:
+            # token not found
+            raise LexerError(LexerError.E_TOKEN_NOT_FOUND, name=name)
+
+        match = token.get('match')
+        if match is None:
+            # token must have 'match' key
+            raise LexerError(LexerError.E_MISSING_MATCH, name=name)
+
+        if isinstance(match, Matcher):
+            # It's leaf token
+            if 'after' not in token: 
+                # leaf token must have 'after' key
+                raise LexerError(LexerError.E_MISSING_AFTER, name=name)
+            if token.get('push') is not None and token.get('pop'):
+                # leaf token can't both push and pop state
+                raise LexerError(LexerError.E_PUSH_AND_POP, name=name)
+            yield name, token
+            continue
+        
+        # it's not leaf token - it contains a list of tokens to try
+
+        if name in onpath:
+            # It's one of parents - so we would just loop endlessly. Raise an
+            # error so we won't do this.
+            raise LexerError(LexerError.E_LOOP, name=name)
+
+        if name in visited:
+            # We have already visited this token once - it's redundant, so we
+            # ignore it without raising an error - it won't hurt.
+            continue
+
+        onpath.add(name)
+        visited.add(name)
+        if groups is not None:
+            groups.append(name)
+
+        stack.append((name, token_iter))
+        token_iter = iter(match)
+
+class Leaf:
+    '''
+    Compiled leaf token - token keys resolved once, so parser doesn't have to
+    look them up on every match attempt
+
+    Besides "match", "after" and hooks, leaf token may have "push" key -
+    name of state to continue in, while state given by "after" is pushed on
+    parser state stack - or "pop" key set to True - then parser continues in
+    state popped from the stack, or in "after" if stack is empty. Leaf token
+    can't have both.
+    '''
+    __slots__ = (
+        'name',
+        'match',
+        'after',
+        'on_match',
+        'on_fail',
+        'has_hooks',
+        'after_static',
+        'next_state',
+        'push',
+        'push_state',
+        'pop',
+        'uses_stack',
+    )
+
+    def __init__(self, name, token):
+        self.name = name
+        self.match = token['match']
+        self.after = token['after']
+        self.on_match = token.get('on_match') or None
+        self.on_fail = token.get('on_fail') or None
+        # only callables are dynamic - anything else (state name, or even
+        # None) is looked up as state
+        self.after_static = not callable(self.after)
+        self.has_hooks = bool(
+            self.on_match or self.on_fail or not self.after_static
+        )
+        # State for static after, set by CompiledLexer
+        self.next_state = None
+        self.push = token.get('push')
+        # State for push, set by CompiledLexer
+        self.push_state = None
+        self.pop = bool(token.get('pop'))
+        self.uses_stack = self.pop or self.push is not None
+
+class State:
+    '''
+    Flattened tuple of leaves to try in given lexer state
+
+    If error is set, it's raised when all leaves fail to match - just where
+    iter_tokens would raise it. It may be LexerError or any other exception
+    raised by iter_tokens on broken lexer.
+    '''
+    __slots__ = (
+        'name',
+        'leaves',
+        'error',
+    )
+
+    def __init__(self, name, leaves, error=None):
+        self.name = name
+        self.leaves = leaves
+        self.error = error
+
+def _copy_token(token):
+    if not isinstance(token, dict):
+        return token
+    match = token.get('match')
+    if match is not None and not isinstance(match, Matcher):
+        return dict(token, match=tuple(match))
+    return dict(token)
+
+class CompiledLexer:
+    '''
+    Compiled lexer - leaves and states of given lexer dict
+
+    Everything is built in constructor and never changed later, so single
+    instance may be shared by parsers running in many threads. Lexer dict is
+    copied and token groups are turned into tuples, so changing it afterwards
+    has no effect.
+    '''
+    def __init__(self, lexer):
+        self.lexer = lexer = {
+            name: _copy_token(token)
+            for name, token in lexer.items()
+        }
+
+        self.leaves = dict()
+        for name, token in lexer.items():
+            if (
+                isinstance(token, dict)
+                and isinstance(token.get('match'), Matcher)
+                and 'after' in token
+            ):
+                self.leaves[name] = Leaf(name, token)
+
+        self.states = dict()
+        for name, token in lexer.items():
+            if isinstance(token, dict):
+                self.states[name] = self.compile_state(name)
+
+        for leaf in self.leaves.values():
+            if leaf.after_static:
+                leaf.next_state = self.get_state(leaf.after)
+            if leaf.push is not None:
+                leaf.push_state = self.get_state(leaf.push)
+
+        self.begin = self.get_state(lexer['_begin'])
+
+    def compile_state(self, name):
+        leaves = list()
+        error = None
+        try:
+            for leaf_name, token in iter_tokens(self.lexer, name):
+                leaves.append(self.leaves[leaf_name])
+        except Exception as e:
+            # raised when state is reached, like iter_tokens would do it -
+            # traceback is dropped, as it keeps frames of compiling code
+            error = e.with_traceback(None)
+        return State(name, tuple(leaves), error)
+
+    def get_state(self, name):
+        state = self.states.get(name)
+        if state is None:
+            # Not a token - compile it without caching, so compiled lexer is
+            # never modified
+            state = self.compile_state(name)
+        return state
+
 class Parser:
-    def __init__(self, lexer, eol_newline = False):
-        self.lexer = lexer
+    '''
+    Lexer runner
+
+    Lines may be str, bytes, bytearray or memoryview. For bytes-like lines
+    positions are byte offsets; bytearrays and memoryviews are split into
+    memoryview lines without copying, so bytearray received from socket is
+    lexed as it is. Don't modify it until parsing is done - when input runs
+    out, parser drops its references to it, so it may be resized again.
+
+    If encoding is given, column() reports positions in characters of
+    bytes-like lines decoded with this encoding.
+
+    Lexer is compiled into CompiledLexer (unless one is given), and
+    run_parser goes through its compiled states - iter_tokens is used only
+    for compiling, so overriding it in subclass has no effect on parsing.
+
+    If spans is set, MRE passes Span objects to token_match instead of match
+    objects - matched text is never copied unless it's asked for, and only
+    the line is kept alive with few offsets. It saves memory when matches
+    are kept, but costs CPU time, as Span is created next to each match
+    object. MS passes its string in both modes.
+    '''
+    def __init__(self, lexer, eol_newline = False, encoding = None, spans = False):
+        if not isinstance(lexer, CompiledLexer):
+            lexer = CompiledLexer(lexer)
+        self.compiled = lexer
+        self.lexer = lexer.lexer
         self.eol_newline = eol_newline
+        self.encoding = encoding
+        self.spans = spans
 
         self.current_readline = None
         self.line_cache = list()
         self.idx_stack = list()
+        self.state_stack = list()
         self.next_lineidx = 0
 
-        self.current_iter = None
+        self.current_state = None
+        self.current_idx = 0
         self.current_line = ''
         self.current_lineno = 0
         self.current_pos = 0
 
-        self.reset_iter(lexer['_begin'])
+        self.current_state = lexer.begin
 
     def parse_readline(self, readline):
         self.current_readline = readline
-        self.run_parser()
+        try:
+            self.run_parser()
+        finally:
+            # input ran out or parsing failed - either way we're done with it
+            self.drop_input()
 
     def parse_lines(self, lines):
         iterator = iter(lines)
@@ -149,11 +494,14 @@ class Parser:
     def readline(self):
         if self.next_lineidx >= len(self.line_cache) and self.current_readline:
             line = self.current_readline()
-            if line:
+            if isinstance(line, (bytearray, memoryview)) and line:
+                self.line_cache.extend(split_buffer(memoryview(line), self.eol_newline))
+            elif line:
                 splitted = line.splitlines()
                 if self.eol_newline:
+                    newline = '\n' if isinstance(line, str) else b'\n'
                     splitted = (
-                        l + '\n'
+                        l + newline
                         for l in splitted
                     )
                 self.line_cache.extend(splitted)
@@ -198,104 +546,623 @@ class Parser:
             self.next_lineidx = 0
 
     def iter_tokens(self, name):
-        onpath = set()
-        visited = set()
+        return iter_tokens(self.lexer, name)
 
-        stack = list()
+    def reset_iter(self, lookup):
+        self.current_state = self.compiled.get_state(lookup)
+        self.current_idx = 0
 
-        token_iter = one_iter(name)
+    def column(self):
+        '''
+        Returns 1-based column of current position - in characters if
+        encoding was given and current line is bytes-like, otherwise it's just
+        an offset
+        '''
+        line = self.current_line
+        if self.encoding is None or isinstance(line, str):
+            return self.current_pos + 1
+        return len(bytes(line[:self.current_pos]).decode(self.encoding, 'replace')) + 1
+
+    def on_bad_token(self):
+        raise LexerError(LexerError.E_NO_MATCH, lineno=self.current_lineno, pos=self.column())
 
+    def drop_input(self):
+        '''
+        Drops references to input lines, so buffers they come from may be
+        modified again
+        '''
+        self.current_readline = None
+        self.current_line = ''
+        self.current_pos = 0
+        self.cache_purge()
+        del self.line_cache[:]
+
+    def token_match(self, token, match):
+        if log.isEnabledFor(DEBUG):
+            log.debug('Matched: {} at line {} pos {}'.format(token, self.current_lineno, self.column()))
+
+    def run_parser(self):
         while True:
-            name = next(token_iter, None)
-            if name is None:
-                if not stack:
+            if self.current_pos >= len(self.current_line) and not self.readline():
+                break
+
+            state = self.current_state
+            leaves = state.leaves
+            line = self.current_line
+            pos = self.current_pos
+            match = None
+
+            for idx in range(self.current_idx, len(leaves)):
+                leaf = leaves[idx]
+                self.cache_push()
+
+                match = leaf.match.match(self, line, pos)
+                if match:
+                    new_pos, match = match
+                    if match is not None:
+                        break
+
+                self.cache_pop()
+                if leaf.on_fail is not None:
+                    # hook may change parser state - start over
+                    self.current_idx = idx + 1
+                    leaf.on_fail(self)
                     break
-                name, token_iter = stack.pop()
-                onpath.remove(name)
+            else:
+                self.current_idx = len(leaves)
+                error = state.error
+                if error is not None:
+                    if isinstance(error, LexerError):
+                        raise LexerError(error.error_id, **error.kwargs)
+                    raise copy.copy(error)
+                self.on_bad_token()
+                break
+
+            if match is None:
                 continue
 
-            token = self.lexer.get(name)
-            if token is None:
-                # token not found
-                raise LexerError(LexerError.E_TOKEN_NOT_FOUND, name=name)
+            self.token_match(leaf.name, match)
 
-            match = token.get('match')
-            if match is None:
-                # token must have 'match' key
-                raise LexerError(LexerError.E_MISSING_MATCH, name=name)
-
-            if isinstance(match, Matcher):
-                # It's leaf token
-                if 'after' not in token: 
-                    # leaf token must have 'after' key
-                    raise LexerError(LexerError.E_MISSING_AFTER, name=name)
-                yield name, token
+            next_state = leaf.next_state
+            if leaf.has_hooks:
+                if leaf.on_match is not None:
+                    leaf.on_match(self)
+                if not leaf.after_static:
+                    next_state = self.compiled.get_state(leaf.after(self))
+
+            if leaf.uses_stack:
+                if leaf.pop:
+                    if self.state_stack:
+                        next_state = self.state_stack.pop()
+                else:
+                    self.state_stack.append(next_state)
+                    next_state = leaf.push_state
+
+            self.current_pos = new_pos
+            self.current_state = next_state
+            self.current_idx = 0
+            self.cache_purge()
+
+# Regex opcodes whose result depends on text around the match - anchors and
+# lookarounds. Regex using any of them can't be trusted to match the same way
+# in probe strings.
+_CONTEXT_OPCODES = (
+    sre_parse.AT,
+    sre_parse.ASSERT,
+    sre_parse.ASSERT_NOT,
+)
+
+def _has_context(value):
+    if isinstance(value, sre_parse.SubPattern):
+        return any(
+            op in _CONTEXT_OPCODES or _has_context(av)
+            for op, av in value
+        )
+    if isinstance(value, (tuple, list)):
+        return any(_has_context(item) for item in value)
+    return False
+
+def _context_free(matcher):
+    regex = matcher.regex
+    return not _has_context(sre_parse.parse(regex.pattern, regex.flags))
+
+def _matcher_shadows(first, second):
+    '''
+    Returns True if first matcher surely matches wherever second would
+    '''
+    if first is second:
+        return True
+
+    if isinstance(first, MM):
+        return any(_matcher_shadows(arg, second) for arg in first.args)
+
+    if isinstance(second, MM):
+        return bool(second.args) and all(
+            _matcher_shadows(first, arg) for arg in second.args
+        )
+
+    if isinstance(first, MRE) and isinstance(second, MRE):
+        if (
+            first.regex.pattern == second.regex.pattern
+            and first.regex.flags == second.regex.flags
+        ):
+            return True
+
+    if isinstance(first, MRE) and _context_free(first):
+        if isinstance(second, MS):
+            if type(first.regex.pattern) is not type(second.string):
+                return False
+            # with icase second matches other cases of its string too
+            if second.icase and not first.regex.flags & re.I:
+                return False
+            return first.regex.match(second.string) is not None
+        # regex matching empty string always matches
+        empty = first.regex.pattern[:0]
+        return first.regex.match(empty) is not None
+
+    if isinstance(first, MS) and isinstance(second, MS):
+        if type(first.string) is not type(second.string):
+            return False
+        if first.icase:
+            return second.string.lower().startswith(first.string)
+        return not second.icase and second.string.startswith(first.string)
+
+    return False
+
+def _matcher_count(matcher):
+    if isinstance(matcher, MM):
+        return sum(_matcher_count(arg) for arg in matcher.args)
+    return 1
+
+class Analysis:
+    '''
+    Result of static lexer analysis - see analyze()
+
+    unreachable - names of tokens never reached from "_begin"
+    shadowed - (state, leaf, shadowing leaf) for leaves never matched in
+        state, because earlier leaf always matches first
+    missing_after - (leaf, after) for static afters and pushes naming missing
+        tokens
+    errors - state name -> LexerError raised when all leaves of state fail
+    worst_case - state name -> matchers tried in state when nothing matches
+    dynamic - names of leaves with callable after - tokens reachable only
+        through them are reported as unreachable too
+    '''
+    def __init__(self):
+        self.unreachable = list()
+        self.shadowed = list()
+        self.missing_after = list()
+        self.errors = dict()
+        self.worst_case = dict()
+        self.dynamic = list()
+
+    def __str__(self):
+        lines = list()
+        for name in self.unreachable:
+            lines.append('Unreachable token "{}".'.format(name))
+        for state, name, by in self.shadowed:
+            lines.append('Token "{}" in state "{}" is shadowed by "{}".'.format(name, state, by))
+        for name, after in self.missing_after:
+            lines.append('Token "{}" has missing after "{}".'.format(name, after))
+        for state, error in self.errors.items():
+            lines.append('State "{}": {}'.format(state, error))
+        for name in self.dynamic:
+            lines.append('Token "{}" has callable after.'.format(name))
+        for state, count in self.worst_case.items():
+            lines.append('State "{}" tries up to {} matchers.'.format(state, count))
+        return '\n'.join(lines)
+
+def analyze(lexer):
+    '''
+    Walks lexer (dict or CompiledLexer) from "_begin" and returns Analysis
+    '''
+    if not isinstance(lexer, CompiledLexer):
+        lexer = CompiledLexer(lexer)
+    result = Analysis()
+
+    # Entry states - "_begin", static afters and pushes of reached leaves.
+    # Tokens are reached in iter_tokens order, so members of group after
+    # the one raising error are not reached.
+    entry_names = [lexer.begin.name]
+    entries = set(entry_names)
+    reached = set()
+    stack = list(entry_names)
+    while stack:
+        groups = list()
+        leaf_names = list()
+        try:
+            for name, token in iter_tokens(lexer.lexer, stack.pop(), groups):
+                leaf_names.append(name)
+        except Exception as e:
+            if isinstance(e, LexerError):
+                reached.add(e.kwargs['name'])
+        reached.update(groups)
+
+        for name in leaf_names:
+            if name in reached:
                 continue
-            
-            # it's not leaf token - it contains a list of tokens to try
+            reached.add(name)
+
+            leaf = lexer.leaves[name]
+            targets = list()
+            if leaf.after_static:
+                targets.append(leaf.after)
+            else:
+                result.dynamic.append(name)
+            if leaf.push is not None:
+                targets.append(leaf.push)
+            for target in targets:
+                if target not in lexer.states:
+                    result.missing_after.append((name, target))
+                elif target not in entries:
+                    entries.add(target)
+                    entry_names.append(target)
+                    stack.append(target)
+
+    result.unreachable = [
+        name
+        for name, token in lexer.lexer.items()
+        if isinstance(token, dict) and name not in reached
+    ]
+
+    for name in entry_names:
+        state = lexer.get_state(name)
+        if state.error is not None:
+            result.errors[name] = state.error
+        result.worst_case[name] = sum(
+            _matcher_count(leaf.match) for leaf in state.leaves
+        )
+        for idx, leaf in enumerate(state.leaves):
+            for earlier in state.leaves[:idx]:
+                if _matcher_shadows(earlier.match, leaf.match):
+                    result.shadowed.append((name, leaf.name, earlier.name))
+                    break
 
-            if name in onpath:
-                # It's one of parents - so we would just loop endlessly. Raise an
-                # error so we won't do this.
-                raise LexerError(LexerError.E_LOOP, name=name)
+    return result
 
-            if name in visited:
-                # We have already visited this token once - it's redundant, so we
-                # ignore it without raising an error - it won't hurt.
+_PLAIN_TYPES = (
+    str,
+    bytes,
+    int,
+    float,
+    complex,
+    bool,
+    type(None),
+    type(Ellipsis),
+)
+
+def _describe(value, seen=None):
+    '''
+    Returns stable description of lexer part, for lexer_digest
+
+    Raises ValueError for values which can't be described reliably.
+    '''
+    if isinstance(value, _PLAIN_TYPES):
+        return value
+
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        # recursive reference - description of it is already in progress
+        return ('recursive', type(value).__qualname__)
+    seen = seen | {id(value)}
+
+    if isinstance(value, (tuple, list)):
+        return tuple(_describe(item, seen) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return ('set',) + tuple(sorted(
+            repr(_describe(item, seen))
+            for item in value
+        ))
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted(
+            (repr(_describe(key, seen)), _describe(item, seen))
+            for key, item in value.items()
+        ))
+    if isinstance(value, re.Pattern):
+        return ('re', value.pattern, value.flags)
+    if isinstance(value, Matcher):
+        fields = getattr(value, '__dict__', None)
+        if fields is None:
+            raise ValueError('Matcher {!r} can\'t be described reliably.'.format(value))
+        return (
+            'matcher',
+            type(value).__module__,
+            type(value).__qualname__,
+            _describe(fields, seen),
+        )
+    if isinstance(value, types.FunctionType):
+        closure = list()
+        for cell in value.__closure__ or ():
+            try:
+                contents = cell.cell_contents
+            except ValueError:
+                # cell not filled yet
+                closure.append(('empty',))
                 continue
+            closure.append(_describe(contents, seen))
+        return (
+            'function',
+            value.__module__,
+            value.__qualname__,
+            _describe(value.__code__, seen),
+            _describe(value.__defaults__, seen),
+            _describe(value.__kwdefaults__, seen),
+            tuple(closure),
+        )
+    if isinstance(value, types.CodeType):
+        return (
+            'code',
+            value.co_code,
+            _describe(value.co_consts, seen),
+            value.co_names,
+            value.co_varnames,
+            value.co_freevars,
+        )
+    if isinstance(value, types.MethodType):
+        return (
+            'method',
+            _describe(value.__func__, seen),
+            _describe(value.__self__, seen),
+        )
+    if isinstance(value, (type, types.BuiltinFunctionType)):
+        return ('named', value.__module__, value.__qualname__)
+    raise ValueError('Lexer part {!r} can\'t be described reliably.'.format(value))
 
-            onpath.add(name)
-            visited.add(name)
+def lexer_digest(lexer):
+    '''
+    Returns sha256 object fed with description of lexer (dict or
+    CompiledLexer)
 
-            stack.append((name, token_iter))
-            token_iter = iter(match)
+    Functions are described by their code, defaults and closure contents.
+    Raises ValueError if lexer contains anything which can't be described
+    reliably - objects other than plain data, matchers, functions, classes
+    and builtins. Globals used by functions are described by name only.
+    '''
+    if isinstance(lexer, CompiledLexer):
+        lexer = lexer.lexer
+    return sha256(repr(_describe(lexer)).encode('utf-8'))
 
-    def reset_iter(self, lookup):
-        self.current_iter = self.iter_tokens(lookup)
+class TokenRecorder(Parser):
+    '''
+    Parser recording matched tokens as (kind, line, start, end) records
 
-    def on_bad_token(self):
-        raise LexerError(LexerError.E_NO_MATCH, lineno=self.current_lineno, pos=self.current_pos+1)
+    Kind is index of token name in names. Parser runs in span mode; end is -1
+    for matches of custom matchers returning neither Span nor matched string.
+    '''
+    def __init__(self, lexer, *args, **kwargs):
+        kwargs['spans'] = True
+        super().__init__(lexer, *args, **kwargs)
+        self.names = tuple(self.compiled.leaves)
+        self.kinds = {name: idx for idx, name in enumerate(self.names)}
+        self.records = array(_RECORD_TYPECODE)
 
     def token_match(self, token, match):
-        log.debug('Matched: {} at line {} pos {}'.format(token, self.current_lineno, self.current_pos+1))
+        start = self.current_pos
+        if isinstance(match, Span):
+            start, end = match.span()
+        elif isinstance(match, (str, bytes)):
+            end = start + len(match)
+        else:
+            end = -1
+        self.records.extend((self.kinds[token], self.current_lineno, start, end))
 
-    def run_parser(self):
-        while True:
-            if self.current_pos >= len(self.current_line) and not self.readline():
-                break
+# magic, version, byte order, digest, names count, names table size,
+# record count
+_STREAM_HEADER = struct.Struct('<4sHcx32sIIQ')
+_STREAM_MAGIC = b'FXDL'
+# Part of cached_tokenize digest too - bump it whenever lexing results change
+_STREAM_VERSION = 3
+# Names table entry: type tag and length, followed by encoded name
+_NAME_HEADER = struct.Struct('<cI')
+_STREAM_BYTEORDER = b'l' if sys.byteorder == 'little' else b'b'
+# Records are (kind, line, start, end) native 64-bit ints, so offsets in huge
+# single-line inputs fit
+_RECORD_TYPECODE = 'q'
+_RECORD_FIELDS = 4
+_RECORD_ITEMSIZE = array(_RECORD_TYPECODE).itemsize
+_RECORD_SIZE = _RECORD_ITEMSIZE * _RECORD_FIELDS
 
-            result = next(self.current_iter, None)
-            if not result:
-                self.on_bad_token()
-                break
+def _encode_name(name):
+    if isinstance(name, str):
+        return b's', name.encode('utf-8', 'surrogatepass')
+    if isinstance(name, bytes):
+        return b'b', name
+    text = repr(name)
+    try:
+        valid = ast.literal_eval(text) == name
+    except (ValueError, SyntaxError):
+        valid = False
+    if not valid:
+        raise ValueError('Token name {!r} can\'t be stored.'.format(name))
+    return b'r', text.encode('utf-8')
 
-            name, token = result
-            matcher = token['match']
-            after = token['after']
- 
-            self.cache_push()
+def _decode_name(tag, data):
+    if tag == b's':
+        return data.decode('utf-8', 'surrogatepass')
+    if tag == b'b':
+        return data
+    if tag == b'r':
+        return ast.literal_eval(data.decode('utf-8'))
+    raise ValueError('Unknown token name type {!r}.'.format(tag))
 
-            match = matcher.match(self, self.current_line, self.current_pos)
-            if match:
-                new_pos, match = match
+def write_token_stream(fileobj, names, records, digest):
+    '''
+    Writes token stream: header, token names table and records array('q')
+    of (kind, line, start, end) - in native byte order
 
-            if match is None:
-                self.cache_pop()
-                on_fail = token.get('on_fail')
-                if on_fail:
-                    on_fail(self)
-                continue
+    Names may be str, bytes, or anything else which repr() can be read back
+    by ast.literal_eval; ValueError is raised for other ones.
+    '''
+    if records.typecode != _RECORD_TYPECODE:
+        raise ValueError('Records must be array({!r}).'.format(_RECORD_TYPECODE))
+    table = list()
+    for name in names:
+        tag, data = _encode_name(name)
+        table.append(_NAME_HEADER.pack(tag, len(data)))
+        table.append(data)
+    table = b''.join(table)
+    table += b'\0' * (-len(table) % _RECORD_ITEMSIZE)
+    fileobj.write(_STREAM_HEADER.pack(
+        _STREAM_MAGIC,
+        _STREAM_VERSION,
+        _STREAM_BYTEORDER,
+        digest,
+        len(names),
+        len(table),
+        len(records) // _RECORD_FIELDS,
+    ))
+    fileobj.write(table)
+    fileobj.write(records.tobytes())
 
-            self.token_match(name, match)
+class TokenStream:
+    '''
+    Token stream read from buffer without copying
 
-            on_match = token.get('on_match')
-            if on_match:
-                on_match(self)
+    Indexing and iterating yields (name, line, start, end) tuples; raw
+    records are available as flat memoryview of ints.
+    '''
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.view = view = memoryview(buffer)
+        records = None
+        try:
+            (
+                magic,
+                version,
+                byteorder,
+                self.digest,
+                names_count,
+                table_size,
+                count,
+            ) = _STREAM_HEADER.unpack_from(view)
+            if (
+                magic != _STREAM_MAGIC
+                or version != _STREAM_VERSION
+                or byteorder != _STREAM_BYTEORDER
+            ):
+                raise ValueError('Not a token stream or incompatible one.')
 
-            callme = getattr(after, '__call__', None)
-            if callme:
-                after = callme(self)
+            offset = _STREAM_HEADER.size
+            table = bytes(view[offset:offset+table_size])
+            if len(table) != table_size:
+                raise ValueError('Token stream is truncated.')
+            names = list()
+            table_offset = 0
+            for idx in range(names_count):
+                tag, size = _NAME_HEADER.unpack_from(table, table_offset)
+                table_offset += _NAME_HEADER.size
+                data = table[table_offset:table_offset+size]
+                if len(data) != size:
+                    raise ValueError('Token stream names table is broken.')
+                table_offset += size
+                names.append(_decode_name(tag, data))
+            self.names = tuple(names)
 
-            self.current_pos = new_pos
-            self.reset_iter(after)
-            self.cache_purge()
+            offset += table_size
+            with view[offset:offset+count*_RECORD_SIZE] as raw:
+                if len(raw) != count*_RECORD_SIZE:
+                    raise ValueError('Token stream is truncated.')
+                records = raw.cast(_RECORD_TYPECODE)
+            with records[::_RECORD_FIELDS] as kinds:
+                if count and not 0 <= min(kinds) <= max(kinds) < names_count:
+                    raise ValueError('Token stream has invalid token kinds.')
+            self.records = records
+        except BaseException:
+            if records is not None:
+                records.release()
+            view.release()
+            raise
+
+    def __len__(self):
+        return len(self.records) // _RECORD_FIELDS
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        offset = idx * _RECORD_FIELDS
+        kind, line, start, end = self.records[offset:offset+_RECORD_FIELDS]
+        return self.names[kind], line, start, end
+
+    def __iter__(self):
+        records = self.records
+        names = self.names
+        for offset in range(0, len(records), _RECORD_FIELDS):
+            kind, line, start, end = records[offset:offset+_RECORD_FIELDS]
+            yield names[kind], line, start, end
+
+    def close(self):
+        self.records.release()
+        self.view.release()
+        close = getattr(self.buffer, 'close', None)
+        if close:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_token_stream(path):
+    '''
+    Maps token stream file to memory and returns TokenStream
+    '''
+    with open(path, 'rb') as fileobj:
+        buffer = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return TokenStream(buffer)
+    except BaseException:
+        buffer.close()
+        raise
+
+def cached_tokenize(path, lexer, cache_dir, encoding=None, eol_newline=False):
+    '''
+    Returns TokenStream of file at path, lexing it only if it or lexer changed
+    since it was cached in cache_dir
+
+    File is lexed as bytes, or as str if encoding is given.
+    '''
+    if not isinstance(lexer, CompiledLexer):
+        lexer = CompiledLexer(lexer)
+
+    with open(path, 'rb') as fileobj:
+        data = fileobj.read()
+
+    digest = lexer_digest(lexer)
+    digest.update(repr((_STREAM_VERSION, encoding, eol_newline)).encode('utf-8'))
+    digest.update(data)
+    digest = digest.digest()
+
+    cache_name = sha256(os.path.abspath(path).encode('utf-8')).hexdigest()
+    cache_path = os.path.join(cache_dir, cache_name + '.tokens')
+
+    try:
+        stream = open_token_stream(cache_path)
+    except (OSError, ValueError, SyntaxError, struct.error):
+        # missing, broken or incompatible - lex it again
+        pass
+    else:
+        if stream.digest == digest:
+            return stream
+        stream.close()
+
+    recorder = TokenRecorder(lexer, eol_newline, encoding)
+    if encoding is None:
+        recorder.parse_lines([memoryview(data)])
+    else:
+        recorder.parse_lines([data.decode(encoding)])
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fileobj:
+            write_token_stream(fileobj, recorder.names, recorder.records, digest)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return open_token_stream(cache_path)
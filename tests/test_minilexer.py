@@ -3,6 +3,10 @@
 from fxd import minilexer
 from unittest import TestCase
 from io import StringIO
+from threading import Thread
+import os
+import sys
+import tempfile
 
 def pass_token(parser):
     pass
@@ -313,6 +317,843 @@ class TestMultiline(TestCase):
 
 
 
+class TestBytes(TestCase):
+    '''
+    Testing bytes-like input
+    '''
+    BYTES_LEXER = dict(
+        _begin = 'begin',
+        begin = dict(
+            match = minilexer.MS(b'word1'),
+            after = 'word2',
+        ),
+        word2 = dict(
+            match = minilexer.MS(b'WORD2', True),
+            after = 'word3',
+        ),
+        word3 = dict(
+            match = minilexer.MRE(rb'wo?rd3\n?$'),
+            after = 'finish',
+        ),
+        finish = dict(
+            match = minilexer.MRE(rb'\n?$'),
+            after = 'should not happen!',
+        ),
+    )
+
+    def test_bytes(self):
+        parser = parse(self.BYTES_LEXER, False, b'word1word2wrd3')
+        self.assertListEqual(parser.matched, ['begin', 'word2', 'word3'])
+        parse(self.BYTES_LEXER, True, b'word1word2wrd3')
+
+    def test_bytearray(self):
+        parse(self.BYTES_LEXER, False, bytearray(b'word1word2wrd3'))
+        parse(self.BYTES_LEXER, True, bytearray(b'word1word2wrd3'))
+
+    def test_memoryview(self):
+        buf = bytearray(b'word1\r\nword2\nword3\n')
+        parser = parse(self.BYTES_LEXER, False, memoryview(buf))
+        self.assertListEqual(parser.matched, ['begin', 'word2', 'word3'])
+        parse(self.BYTES_LEXER, True, memoryview(bytearray(b'word1word2wrd3\n')))
+
+    def test_buffer_released(self):
+        buf = bytearray(b'word1word2wrd3\n')
+        parse(self.BYTES_LEXER, False, memoryview(buf))
+        del buf[:4]
+
+        buf = bytearray(b'word1word2wrd3\n')
+        with memoryview(buf) as view:
+            parse(self.BYTES_LEXER, False, view)
+        del buf[:4]
+
+        buf = bytearray(b'word1word2wrd3\n')
+        parser = parse(self.BYTES_LEXER, False, buf)
+        self.assertListEqual(parser.matched, ['begin', 'word2', 'word3'])
+        del buf[:4]
+
+        buf = bytearray(b'word1spam\n')
+        with self.assertRaises(minilexer.LexerError):
+            parse(self.BYTES_LEXER, False, memoryview(buf))
+        buf.extend(b'eggs')
+
+        def raising(parser):
+            raise WellDone()
+
+        my_lexer = dict(self.BYTES_LEXER, begin=dict(
+            match = minilexer.MS(b'word1'),
+            on_match = raising,
+            after = 'word2',
+        ))
+        buf = bytearray(b'word1word2wrd3\n')
+        with self.assertRaises(WellDone):
+            parse(my_lexer, False, buf)
+        buf.extend(b'eggs')
+
+    def test_split_buffer(self):
+        view = memoryview(b'a\r\nbb\n\rc')
+        lines = list(minilexer.split_buffer(view))
+        self.assertListEqual([bytes(l) for l in lines], b'a\r\nbb\n\rc'.splitlines())
+        self.assertTrue(all(isinstance(l, memoryview) for l in lines))
+        lines = list(minilexer.split_buffer(view, True))
+        self.assertListEqual([bytes(l) for l in lines], [b'a\n', b'bb\n', b'\n', b'c\n'])
+
+    def test_column(self):
+        my_lexer = dict(
+            self.BYTES_LEXER,
+            begin = dict(
+                match = minilexer.MS('zażółć'.encode('utf-8')),
+                after = 'finish',
+            ),
+        )
+        parser = minilexer.Parser(my_lexer)
+        with self.assertRaises(minilexer.LexerError) as cm:
+            parser.parse_lines(['zażółć!'.encode('utf-8')])
+        self.assertEqual(cm.exception.kwargs['pos'], 11)
+
+        parser = minilexer.Parser(my_lexer, encoding='utf-8')
+        with self.assertRaises(minilexer.LexerError) as cm:
+            parser.parse_lines(['zażółć!'.encode('utf-8')])
+        self.assertEqual(cm.exception.kwargs['pos'], 7)
+
+
+class TestSpans(TestCase):
+    '''
+    Testing span mode
+    '''
+    class SpanParser(minilexer.Parser):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, spans=True, **kwargs)
+            self.matched = list()
+
+        def token_match(self, token, match):
+            self.matched.append(match)
+
+    def test_spans(self):
+        my_lexer = dict(
+            BASE,
+            begin = dict(
+                match = minilexer.MS('key'),
+                after = 'value',
+            ),
+            value = dict(
+                match = minilexer.MRE('=(?:"([^"]*)"|(\\w+))'),
+                after = 'finish',
+            ),
+        )
+        parser = self.SpanParser(my_lexer)
+        parser.parse_lines(['key="spam"'])
+        key, value = parser.matched
+        self.assertEqual(key, 'key')
+        self.assertIsInstance(value, minilexer.Span)
+        self.assertEqual(value.span(), (3, 10))
+        self.assertEqual(value.start(), 3)
+        self.assertEqual(value.end(), 10)
+        self.assertEqual(value.span(1), (5, 9))
+        self.assertEqual(value.start(1), 5)
+        self.assertEqual(value.group(1), 'spam')
+        self.assertIsNone(value.group(2))
+        self.assertEqual(value.text, '="spam"')
+        self.assertRaises(IndexError, value.span, 3)
+        self.assertRaises(IndexError, value.group, -1)
+
+    def test_named_groups(self):
+        my_lexer = dict(
+            BASE,
+            begin = dict(
+                match = minilexer.MRE('(?P<key>\\w+)=(?P<value>\\w+)?'),
+                after = 'finish',
+            ),
+        )
+        parser = self.SpanParser(my_lexer)
+        parser.parse_lines(['key='])
+        match, = parser.matched
+        self.assertEqual(match.group('key'), 'key')
+        self.assertEqual(match.span('key'), (0, 3))
+        self.assertEqual(match.end('key'), 3)
+        self.assertIsNone(match.group('value'))
+        self.assertDictEqual(match.groupdict(), {'key': 'key', 'value': None})
+        self.assertRaises(IndexError, match.group, 'spam')
+
+        my_lexer['begin'] = dict(
+            match = minilexer.MRE('\\w+'),
+            after = 'finish',
+        )
+        parser = self.SpanParser(my_lexer)
+        parser.parse_lines(['key'])
+        self.assertRaises(IndexError, parser.matched[0].group, 'key')
+
+    def test_memoryview_spans(self):
+        my_lexer = dict(
+            BASE,
+            begin = dict(
+                match = minilexer.MS(b'KEY', True),
+                after = 'value',
+            ),
+            value = dict(
+                match = minilexer.MRE(rb'=\w+'),
+                after = 'finish',
+            ),
+            finish = dict(
+                match = minilexer.MRE(rb'\n?$'),
+                after = 'should not happen!',
+            ),
+        )
+        parser = self.SpanParser(my_lexer)
+        parser.parse_lines([memoryview(b'key=spam\n')])
+        key, value = parser.matched
+        self.assertEqual(key, b'key')
+        self.assertIsInstance(value.text, memoryview)
+        self.assertEqual(bytes(value.group()), b'=spam')
+        self.assertRaises(IndexError, value.group, 1)
+        self.assertRaises(IndexError, value.end, 1)
+
+
+class TestCompiledTokens(TestCase):
+    '''
+    Testing compiled leaves and states
+    '''
+    def test_shared_leaves(self):
+        my_lexer = dict(
+            BASE,
+            begin = dict(
+                match = (
+                    'word1',
+                    'word2',
+                    'finish',
+                ),
+            ),
+            word1 = dict(
+                match = minilexer.MS('word1'),
+                after = 'begin',
+            ),
+            word2 = dict(
+                match = minilexer.MS('word2'),
+                after = 'begin',
+            ),
+        )
+        parser = parse(my_lexer, False, 'word1word2word1')
+        self.assertListEqual(parser.matched, ['word1', 'word2', 'word1'])
+        state = parser.compiled.states['begin']
+        self.assertListEqual([leaf.name for leaf in state.leaves], ['word1', 'word2', 'finish'])
+        self.assertIs(state.leaves[0].next_state, state)
+        self.assertFalse(state.leaves[0].has_hooks)
+        self.assertIsNone(state.error)
+
+    def test_on_fail_reset_iter(self):
+        def switch(parser):
+            parser.reset_iter('word2')
+
+        my_lexer = dict(
+            BASE,
+            begin = dict(
+                match = (
+                    'word1',
+                    'never',
+                ),
+            ),
+            word1 = dict(
+                match = minilexer.MS('word1'),
+                on_fail = switch,
+                after = 'finish',
+            ),
+            never = dict(
+                match = minilexer.MS('word2'),
+                after = 'finish',
+            ),
+            word2 = dict(
+                match = minilexer.MS('word2'),
+                after = 'finish',
+            ),
+        )
+        parser = parse(my_lexer, False, 'word2')
+        self.assertListEqual(parser.matched, ['word2'])
+
+    def test_lazy_error(self):
+        my_lexer = dict(
+            BASE,
+            begin = dict(
+                match = (
+                    'word1',
+                    'missing',
+                ),
+            ),
+            word1 = dict(
+                match = minilexer.MS('word1'),
+                after = 'finish',
+            ),
+        )
+        # missing token is never reached
+        parse(my_lexer, False, 'word1')
+        self.assertRaises(minilexer.LexerError, parse, my_lexer, False, 'word2')
+
+
+class TestStateStack(TestCase):
+    '''
+    Testing push and pop token keys
+    '''
+    MY_LEXER = dict(
+        BASE,
+        begin = dict(
+            match = (
+                'open',
+                'word',
+                'finish',
+            ),
+        ),
+        nested = dict(
+            match = (
+                'nested_open',
+                'close',
+                'nested_word',
+            ),
+        ),
+        word = dict(
+            match = minilexer.MRE('[a-z]+'),
+            after = 'begin',
+        ),
+        nested_word = dict(
+            match = minilexer.MRE('[a-z]+'),
+            after = 'nested',
+        ),
+        open = dict(
+            match = minilexer.MS('('),
+            push = 'nested',
+            after = 'begin',
+        ),
+        nested_open = dict(
+            match = minilexer.MS('('),
+            push = 'nested',
+            after = 'nested',
+        ),
+        close = dict(
+            match = minilexer.MS(')'),
+            pop = True,
+            after = 'begin',
+        ),
+    )
+
+    def test_nesting(self):
+        parser = parse(self.MY_LEXER, False, 'a(b(c)d)e')
+        self.assertListEqual(parser.matched, [
+            'word', 'open', 'nested_word', 'nested_open', 'nested_word',
+            'close', 'nested_word', 'close', 'word',
+        ])
+        self.assertListEqual(parser.state_stack, [])
+
+    def test_unbalanced(self):
+        parser = parse(self.MY_LEXER, False, '((a)')
+        self.assertEqual(parser.current_state.name, 'nested')
+        self.assertListEqual([state.name for state in parser.state_stack], ['begin'])
+        # ")" is not allowed outside of brackets
+        self.assertRaises(minilexer.LexerError, parse, self.MY_LEXER, False, 'a)')
+
+    def test_pop_empty(self):
+        my_lexer = dict(
+            self.MY_LEXER,
+            begin = dict(
+                match = (
+                    'close',
+                    'word',
+                    'finish',
+                ),
+            ),
+        )
+        parser = parse(my_lexer, False, ')a')
+        self.assertListEqual(parser.matched, ['close', 'word'])
+
+    def test_push_callable_after(self):
+        my_lexer = dict(
+            self.MY_LEXER,
+            open = dict(
+                match = minilexer.MS('('),
+                push = 'nested',
+                after = lambda parser: 'begin',
+            ),
+        )
+        parser = parse(my_lexer, False, '(a)b')
+        self.assertListEqual(parser.matched, ['open', 'nested_word', 'close', 'word'])
+
+    def test_push_and_pop(self):
+        my_lexer = dict(
+            self.MY_LEXER,
+            close = dict(
+                match = minilexer.MS(')'),
+                push = 'nested',
+                pop = True,
+                after = 'begin',
+            ),
+        )
+        with self.assertRaises(minilexer.LexerError) as cm:
+            parse(my_lexer, False, '(a)')
+        self.assertEqual(cm.exception.error_id, minilexer.LexerError.E_PUSH_AND_POP)
+
+    def test_analyze(self):
+        result = minilexer.analyze(dict(self.MY_LEXER, open=dict(
+            match = minilexer.MS('('),
+            push = 'missing',
+            after = 'begin',
+        )))
+        self.assertIn(('open', 'missing'), result.missing_after)
+        self.assertIn('close', result.unreachable)
+
+
+class TestCompiledLexer(TestCase):
+    '''
+    Testing compiled lexer shared by many parsers
+    '''
+    MY_LEXER = dict(
+        BASE,
+        begin = dict(
+            match = (
+                'word1',
+                'word2',
+                'finish',
+            ),
+        ),
+        word1 = dict(
+            match = minilexer.MS('word1'),
+            after = 'begin',
+        ),
+        word2 = dict(
+            match = minilexer.MS('word2'),
+            after = 'begin',
+        ),
+    )
+
+    def test_shared(self):
+        compiled = minilexer.CompiledLexer(self.MY_LEXER)
+        results = list()
+
+        def worker(line):
+            parser = TestParserSubclass(compiled)
+            parser.parse_lines([line] * 50)
+            results.append((line, parser.matched))
+
+        threads = [
+            Thread(target=worker, args=(line,))
+            for line in ('word1word2', 'word2word2word1', 'word1') * 4
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 12)
+        for line, matched in results:
+            self.assertEqual(len(matched), line.count('word') * 50)
+
+    def test_lexer_copied(self):
+        my_lexer = dict(self.MY_LEXER)
+        compiled = minilexer.CompiledLexer(my_lexer)
+        del my_lexer['word2']
+        parser = TestParserSubclass(compiled)
+        parser.parse_lines(['word2word1'])
+        self.assertListEqual(parser.matched, ['word2', 'word1'])
+
+        my_lexer['word1'] = dict(my_lexer['word1'])
+        compiled = minilexer.CompiledLexer(my_lexer)
+        my_lexer['word1']['after'] = 'spam'
+        self.assertEqual(compiled.lexer['word1']['after'], 'begin')
+
+    def test_unknown_state(self):
+        compiled = minilexer.CompiledLexer(self.MY_LEXER)
+        state = compiled.get_state('spam')
+        self.assertEqual(state.error.error_id, minilexer.LexerError.E_TOKEN_NOT_FOUND)
+        self.assertNotIn('spam', compiled.states)
+
+    def test_after_none(self):
+        class BadTokenParser(TestParserSubclass):
+            def on_bad_token(self):
+                self.bad_token = self.current_pos
+
+        my_lexer = dict(
+            BASE,
+            begin = dict(
+                match = minilexer.MS('word'),
+                after = None,
+            ),
+        )
+        parser = BadTokenParser(my_lexer)
+        parser.parse_lines(['wordword'])
+        self.assertListEqual(parser.matched, ['begin'])
+        self.assertEqual(parser.bad_token, 4)
+
+    def test_broken_member_not_reached(self):
+        my_lexer = dict(
+            BASE,
+            begin = dict(
+                match = (
+                    'word',
+                    'broken',
+                ),
+            ),
+            word = dict(
+                match = minilexer.MS('word'),
+                after = 'begin',
+            ),
+            broken = 'oops',
+        )
+        parser = parse(my_lexer, False, 'wordword')
+        self.assertListEqual(parser.matched, ['word', 'word'])
+        # reached only when "word" doesn't match
+        self.assertRaises(AttributeError, parse, my_lexer, False, 'spam')
+
+
+class TestAnalyze(TestCase):
+    '''
+    Testing static lexer analysis
+    '''
+    def test_analyze(self):
+        my_lexer = dict(
+            _begin = 'begin',
+            begin = dict(
+                match = (
+                    'for_',
+                    'format',
+                    'name',
+                    'keyword',
+                    'number',
+                    'space',
+                ),
+            ),
+            keyword = dict(
+                match = minilexer.MM(
+                    minilexer.MS('if'),
+                    minilexer.MS('else'),
+                ),
+                after = 'begin',
+            ),
+            number = dict(
+                match = minilexer.MRE('[0-9]+'),
+                after = 'begin',
+            ),
+            space = dict(
+                match = minilexer.MRE(r'\s+(?=\S)'),
+                after = 'missing',
+            ),
+            for_ = dict(
+                match = minilexer.MS('for'),
+                after = 'begin',
+            ),
+            format = dict(
+                match = minilexer.MS('format'),
+                after = 'begin',
+            ),
+            name = dict(
+                match = minilexer.MRE('[a-z]+'),
+                after = 'begin',
+            ),
+            dynamic = dict(
+                match = minilexer.MS('spam'),
+                after = lambda parser: 'begin',
+            ),
+        )
+        result = minilexer.analyze(my_lexer)
+        self.assertListEqual(result.unreachable, ['dynamic'])
+        self.assertListEqual(result.shadowed, [
+            ('begin', 'format', 'for_'),
+            ('begin', 'keyword', 'name'),
+        ])
+        self.assertListEqual(result.missing_after, [('space', 'missing')])
+        self.assertDictEqual(result.worst_case, {'begin': 7})
+        self.assertDictEqual(result.errors, {})
+        self.assertIn('Unreachable token "dynamic".', str(result))
+
+    def test_analyze_errors(self):
+        my_lexer = dict(
+            BASE,
+            begin = dict(
+                match = (
+                    'word',
+                    'missing',
+                ),
+            ),
+            word = dict(
+                match = minilexer.MS('word'),
+                after = lambda parser: 'finish',
+            ),
+        )
+        result = minilexer.analyze(minilexer.CompiledLexer(my_lexer))
+        self.assertListEqual(result.unreachable, ['finish'])
+        self.assertListEqual(result.dynamic, ['word'])
+        self.assertEqual(result.errors['begin'].error_id, minilexer.LexerError.E_TOKEN_NOT_FOUND)
+
+    def test_analyze_anchors(self):
+        my_lexer = dict(
+            BASE,
+            begin = dict(
+                match = (
+                    'y',
+                    'x',
+                    'z',
+                ),
+            ),
+            y = dict(
+                match = minilexer.MRE(r'a\\$'),
+                after = 'begin',
+            ),
+            x = dict(
+                match = minilexer.MS('a\\'),
+                after = 'begin',
+            ),
+            z = dict(
+                match = minilexer.MRE(r'(?:[$^]|(?=b))'),
+                after = 'begin',
+            ),
+        )
+        result = minilexer.analyze(my_lexer)
+        self.assertListEqual(result.shadowed, [])
+        parser = parse(my_lexer, False, 'a\\a\\')
+        self.assertListEqual(parser.matched, ['x', 'y'])
+
+        # characters in sets are not anchors
+        my_lexer['y'] = dict(
+            match = minilexer.MRE(r'[$^a]\\'),
+            after = 'begin',
+        )
+        result = minilexer.analyze(my_lexer)
+        self.assertListEqual(result.shadowed, [('begin', 'x', 'y')])
+
+    def test_analyze_dead_members(self):
+        my_lexer = dict(
+            BASE,
+            begin = dict(
+                match = (
+                    'word',
+                    'missing',
+                    'other',
+                ),
+            ),
+            word = dict(
+                match = minilexer.MS('word'),
+                after = 'finish',
+            ),
+            other = dict(
+                match = minilexer.MS('other'),
+                after = 'finish',
+            ),
+        )
+        result = minilexer.analyze(my_lexer)
+        self.assertListEqual(result.unreachable, ['other'])
+        self.assertEqual(result.errors['begin'].kwargs['name'], 'missing')
+
+    def test_analyze_push_and_pop(self):
+        my_lexer = dict(
+            BASE,
+            begin = dict(
+                match = minilexer.MS('word'),
+                push = 'finish',
+                pop = True,
+                after = 'finish',
+            ),
+        )
+        result = minilexer.analyze(my_lexer)
+        self.assertEqual(result.errors['begin'].error_id, minilexer.LexerError.E_PUSH_AND_POP)
+
+
+def count_lexed(parser):
+    TestTokenStream.lexed += 1
+
+class TestTokenStream(TestCase):
+    '''
+    Testing token stream cache
+    '''
+    lexed = 0
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'input.txt')
+        self.cache_dir = os.path.join(self.tmpdir.name, 'cache')
+        TestTokenStream.lexed = 0
+
+        self.my_lexer = dict(
+            _begin = 'begin',
+            begin = dict(
+                match = (
+                    'word',
+                    'space',
+                ),
+            ),
+            word = dict(
+                match = minilexer.MRE(rb'\w+'),
+                on_match = count_lexed,
+                after = 'begin',
+            ),
+            space = dict(
+                match = minilexer.MRE(rb'\s+'),
+                after = 'begin',
+            ),
+        )
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, data):
+        with open(self.path, 'wb') as fileobj:
+            fileobj.write(data)
+
+    def test_cached_tokenize(self):
+        self.write(b'spam eggs\nham')
+        with minilexer.cached_tokenize(self.path, self.my_lexer, self.cache_dir) as stream:
+            self.assertEqual(self.lexed, 3)
+            self.assertListEqual(list(stream), [
+                ('word', 1, 0, 4),
+                ('space', 1, 4, 5),
+                ('word', 1, 5, 9),
+                ('word', 2, 0, 3),
+            ])
+            self.assertEqual(len(stream), 4)
+            self.assertEqual(stream[-1], ('word', 2, 0, 3))
+            self.assertRaises(IndexError, stream.__getitem__, 4)
+
+        # cached
+        with minilexer.cached_tokenize(self.path, self.my_lexer, self.cache_dir) as stream:
+            self.assertEqual(self.lexed, 3)
+            self.assertEqual(len(stream), 4)
+
+        # input changed
+        self.write(b'spam')
+        with minilexer.cached_tokenize(self.path, self.my_lexer, self.cache_dir) as stream:
+            self.assertEqual(self.lexed, 4)
+            self.assertListEqual(list(stream), [('word', 1, 0, 4)])
+
+        # lexer changed
+        self.my_lexer['space'] = dict(
+            match = minilexer.MRE(rb' +'),
+            after = 'begin',
+        )
+        with minilexer.cached_tokenize(self.path, self.my_lexer, self.cache_dir) as stream:
+            self.assertEqual(self.lexed, 5)
+
+    def test_decoded(self):
+        self.write('zażółć gęślą'.encode('utf-8'))
+        my_lexer = dict(
+            _begin = 'begin',
+            begin = dict(
+                match = (
+                    'word',
+                    'space',
+                ),
+            ),
+            word = dict(
+                match = minilexer.MRE(r'\w+'),
+                after = 'begin',
+            ),
+            space = dict(
+                match = minilexer.MS(' '),
+                after = 'begin',
+            ),
+        )
+        with minilexer.cached_tokenize(self.path, my_lexer, self.cache_dir, 'utf-8') as stream:
+            self.assertEqual(stream[2], ('word', 1, 7, 12))
+
+    def test_broken_cache(self):
+        self.write(b'spam')
+        minilexer.cached_tokenize(self.path, self.my_lexer, self.cache_dir).close()
+        for name in os.listdir(self.cache_dir):
+            with open(os.path.join(self.cache_dir, name), 'r+b') as fileobj:
+                fileobj.truncate(60)
+        with minilexer.cached_tokenize(self.path, self.my_lexer, self.cache_dir) as stream:
+            self.assertEqual(self.lexed, 2)
+            self.assertEqual(len(stream), 1)
+
+    def test_names(self):
+        self.write(b'spam eggs')
+        my_lexer = {
+            '_begin': 'begin',
+            'begin': dict(match = ('', 'sp\0ace', 7, ('a', b'b'), b'bytes')),
+            '': dict(match = minilexer.MRE(rb'\w+'), after = 'begin'),
+            'sp\0ace': dict(match = minilexer.MRE(rb'\s'), after = 'begin'),
+            7: dict(match = minilexer.MS(b'7'), after = 'begin'),
+            ('a', b'b'): dict(match = minilexer.MS(b'8'), after = 'begin'),
+            b'bytes': dict(match = minilexer.MS(b'9'), after = 'begin'),
+        }
+        for idx in range(2):
+            with minilexer.cached_tokenize(self.path, my_lexer, self.cache_dir) as stream:
+                self.assertTupleEqual(stream.names, ('', 'sp\0ace', 7, ('a', b'b'), b'bytes'))
+                self.assertListEqual([token[0] for token in stream], ['', 'sp\0ace', ''])
+
+        my_lexer[object()] = dict(match = minilexer.MS(b'0'), after = 'begin')
+        self.assertRaises(ValueError, minilexer.cached_tokenize, self.path, my_lexer, self.cache_dir)
+
+    def test_invalid_kinds(self):
+        self.write(b'spam')
+        minilexer.cached_tokenize(self.path, self.my_lexer, self.cache_dir).close()
+        cache_path, = (
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir)
+        )
+        with open(cache_path, 'r+b') as fileobj:
+            data = bytearray(fileobj.read())
+            # first record starts right after header and padded names table
+            table_size = int.from_bytes(data[44:48], 'little')
+            offset = 56 + table_size
+            size = minilexer._RECORD_ITEMSIZE
+            data[offset:offset+size] = (99).to_bytes(size, sys.byteorder)
+            fileobj.seek(0)
+            fileobj.write(data)
+        self.assertRaises(ValueError, minilexer.open_token_stream, cache_path)
+        with minilexer.cached_tokenize(self.path, self.my_lexer, self.cache_dir) as stream:
+            self.assertEqual(self.lexed, 2)
+            self.assertListEqual(list(stream), [('word', 1, 0, 4)])
+
+    def test_digest_callables(self):
+        def digest(after):
+            return minilexer.lexer_digest(dict(
+                BASE,
+                begin = dict(
+                    match = minilexer.MS('word'),
+                    after = after,
+                ),
+            )).digest()
+
+        self.assertEqual(digest(lambda p: 'finish'), digest(lambda p: 'finish'))
+        self.assertNotEqual(digest(lambda p: 'finish'), digest(lambda p: 'spam'))
+
+        def make_after(name):
+            return lambda p: name
+        self.assertNotEqual(digest(make_after('finish')), digest(make_after('spam')))
+
+        class Callable:
+            def __call__(self, parser):
+                return 'finish'
+        self.assertRaises(ValueError, digest, Callable())
+
+    def test_digest_matchers(self):
+        class MW(minilexer.MRE):
+            def match(self, parser, line, pos):
+                return super().match(parser, line.lower(), pos)
+
+        def digest(matcher):
+            return minilexer.lexer_digest(dict(
+                BASE,
+                begin = dict(
+                    match = matcher,
+                    after = 'finish',
+                ),
+            )).digest()
+
+        self.assertEqual(digest(minilexer.MRE('x')), digest(minilexer.MRE('x')))
+        self.assertNotEqual(digest(minilexer.MRE('x')), digest(MW('x')))
+        self.assertNotEqual(digest(minilexer.MRE('x')), digest(minilexer.MRE('x', True)))
+        self.assertNotEqual(
+            digest(minilexer.MM(minilexer.MS('x'))),
+            digest(minilexer.MM(minilexer.MS('x', True))),
+        )
+
+    def test_uncachable(self):
+        self.write(b'spam')
+        my_lexer = dict(
+            self.my_lexer,
+            space = dict(
+                match = minilexer.MRE(rb'\s+'),
+                on_match = object(),
+                after = 'begin',
+            ),
+        )
+        self.assertRaises(ValueError, minilexer.cached_tokenize, self.path, my_lexer, self.cache_dir)
+
+
 class TestBaseLexerNegatives(TestCase):
     '''
     Testing negative matches - error handling etc
@@ -475,3 +1316,4 @@ class CoveragePenisEnlargement(TestCase):
         self.assertIn('spam', str(minilexer.LexerError(minilexer.LexerError.E_MISSING_AFTER, name='spam')))
         self.assertIn('spam', str(minilexer.LexerError(minilexer.LexerError.E_LOOP, name='spam')))
         self.assertIn('spam', str(minilexer.LexerError(minilexer.LexerError.E_NO_MATCH, lineno='spam', pos='eggs')))
+        self.assertIn('spam', str(minilexer.LexerError(minilexer.LexerError.E_PUSH_AND_POP, name='spam')))